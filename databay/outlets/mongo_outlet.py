@@ -8,22 +8,24 @@
 """
 
 
+import asyncio
 import functools
 import logging
-from typing import List
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple
 
 import pymongo
+from pymongo.errors import CollectionInvalid, ConnectionFailure
+from pymongo.write_concern import WriteConcern
 
 from databay.outlet import Outlet, metadata
 from databay import Record
 
 _LOGGER = logging.getLogger('databay.MongoOutlet')
 
-class MongoCollectionNotFound(Exception):
-    """ Raised when requested collection does not exist in the database."""
-    pass
-
-
 def ensure_connection(fn):
     """
     Ensure the MongoDB connection is established before running the function.
@@ -41,13 +43,20 @@ def ensure_connection(fn):
 
 class MongoOutlet(Outlet):
     """
-    Outlet for pushing data into a MongoDB instance. Pushes are executed synchronously.
+    Outlet for pushing data into a MongoDB instance. Writes are executed in a thread pool, without blocking the event loop.
+
+    Payloads are written as they are, hence inlets that already hold BSON data can produce :code:`bson.raw_bson.RawBSONDocument` payloads, which PyMongo sends to the server without encoding them again. Note that PyMongo doesn't add an :code:`_id` to such documents, leaving it to the server to generate it.
     """
 
     MONGODB_COLLECTION:metadata = 'MongoOutlet.MONGODB_COLLECTION'
     """ Name of collection to write to. """
 
-    def __init__(self, database_name:str='databay', collection:str='default_collection', host:str=None, port:str=None):
+    _clients:Dict[Tuple, list] = {}
+    """ MongoClients shared between outlets, stored as (host, port, client options...) -> [client, number of outlets using it]. """
+
+    _clients_lock = threading.Lock()
+
+    def __init__(self, database_name:str='databay', collection:str='default_collection', host:str=None, port:str=None, batch_size:int=1000, ordered:bool=False, fast_insert:bool=False, max_pool_size:int=100, compressors:str=None, retry_writes:bool=True, buffer_size:int=None, buffer_interval:float=None, max_workers:int=None):
         """
 
         :type database_name: str
@@ -65,6 +74,44 @@ class MongoOutlet(Outlet):
         :type port: int
         :param port: Port of the MongoDB host.
             |default| :code:`None` (PyMongo defaults to :code:`27017`)
+
+        :type batch_size: int
+        :param batch_size: Maximum number of documents sent to MongoDB in a single :code:`insert_many` call. Larger pushes are split into multiple batches.
+            |default| :code:`1000`
+
+        :type ordered: bool
+        :param ordered: Whether MongoDB should perform the inserts in order and stop at the first failed document. Unordered inserts let the server process the batch without serialising on each document.
+            |default| :code:`False`
+
+        :type fast_insert: bool
+        :param fast_insert: Whether to write with an unacknowledged write concern (:code:`w=0`). Writes no longer wait for the server's acknowledgement, at the cost of server errors - such as duplicate keys or failed validation - no longer being reported by :any:`push`.
+            |default| :code:`False`
+
+        :type max_pool_size: int
+        :param max_pool_size: Maximum number of concurrent connections the MongoClient keeps to the host.
+            |default| :code:`100`
+
+        :type compressors: str
+        :param compressors: Comma-separated list of wire protocol compressors to negotiate with the server, eg. :code:`'snappy,zstd,zlib'`. Compression reduces the bytes sent for large pushes. Note that :code:`'snappy'` and :code:`'zstd'` require the :code:`python-snappy` and :code:`zstandard` packages respectively.
+            |default| :code:`None` (No compression)
+
+        :type retry_writes: bool
+        :param retry_writes: Whether the MongoClient should retry writes once after a network error.
+            |default| :code:`True`
+
+        :type buffer_size: int
+        :param buffer_size: If provided, documents are buffered and written once at least this many documents are waiting, turning many small pushes into fewer larger writes.
+            |default| :code:`None` (Documents are written on each push)
+
+        :type buffer_interval: float
+        :param buffer_interval: If provided, documents are buffered and written on the first push taking place at least this many seconds after the previous write. Can be combined with :code:`buffer_size`. Any documents still buffered are written on shutdown.
+
+            Buffered documents whose write fails with a connection error (:code:`ConnectionFailure`) are put back into the buffer and retried with the next write. Documents failing with any other error - such as documents rejected by the server or ones that can't be encoded - are not retried, and neither are documents failing to be written on shutdown. These are lost and logged as errors.
+            |default| :code:`None` (Documents are written on each push)
+
+        :type max_workers: int
+        :param max_workers: Number of threads writing to MongoDB. The threads are started on start and shared by all pushes of this outlet.
+            |default| :code:`None` (:any:`ThreadPoolExecutor <concurrent.futures.ThreadPoolExecutor>` default)
         """
         super().__init__()
 
@@ -72,9 +119,29 @@ class MongoOutlet(Outlet):
         self.port = port
         self.database_name = database_name
         self.collection = collection
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.fast_insert = fast_insert
+        self.max_pool_size = max_pool_size
+        self.compressors = compressors
+        self.retry_writes = retry_writes
+        self.buffer_size = buffer_size
+        self.buffer_interval = buffer_interval
+        self._buffer = defaultdict(list) # collection name -> documents waiting to be written
+        self._buffer_count = 0
+        self._buffer_lock = threading.Lock()
+        self._closed = False # set on shutdown, pushes arriving afterwards are rejected
+        self._pushes_in_flight = 0
+        self._pushes_condition = threading.Condition()
+        self._last_flush = time.monotonic()
+        self.max_workers = max_workers
+        self._executor = None
         self._client = None
+        self._client_key = None
         self._db = None # _db == None means disconnected
-        self._collections = []
+        self._collections = None # names of existing collections, listed on first _add_collection
+        self._collections_lock = threading.Lock()
+        self._collection_cache = {} # collection name -> PyMongo Collection
 
     def _group_by_collection(self, records:List[Record]):
         """
@@ -85,26 +152,26 @@ class MongoOutlet(Outlet):
         :return: Grouped records
         :rtype: Dict[str, :any:`Record`]
         """
-        collections = {}
+        collections = defaultdict(list)
 
-        for record in records:
-            collection_name = record.metadata.get(self.MONGODB_COLLECTION, self.collection)
+        # hoisted out of the loop to save attribute lookups on each record
+        collection_key = self.MONGODB_COLLECTION
+        default_collection = self.collection
 
-            if collection_name not in collections: collections[collection_name] = []
+        for record in records:
+            bucket = collections[record.metadata.get(collection_key, default_collection)]
+            payload = record.payload
 
-            if isinstance(record.payload, list):
-                collections[collection_name] += record.payload
+            if isinstance(payload, list):
+                bucket.extend(payload)
             else:
-                collections[collection_name].append(record.payload)
+                bucket.append(payload)
 
-        return collections
+        return dict(collections)
 
-    @ensure_connection
-    def push(self, records:[Record], update):
+    async def push(self, records:[Record], update):
         """
-        |decorated| :any:`ensure_connection`
-
-        Write records into the database. Writes are executed synchronously.
+        Write records into the database. Writes are executed in this outlet's thread pool, allowing other links to carry on while MongoDB is being written to. Each collection is written to concurrently, and so are the batches of unordered writes.
 
         :type records: list[:any:`Record`]
         :param records: List of records generated by inlets. Each top-level element of this array corresponds to one inlet that successfully returned data. Note that inlets could return arrays too, making this a nested array.
@@ -117,21 +184,140 @@ class MongoOutlet(Outlet):
         if not self.active:
             return False
 
+        with self._pushes_condition:
+            if self._closed: # shutdown started after the active check
+                return False
+            self._pushes_in_flight += 1
+
+        try:
+            return await self._write_records(records, update)
+        finally:
+            with self._pushes_condition:
+                self._pushes_in_flight -= 1
+                self._pushes_condition.notify_all()
+
+    async def _write_records(self, records:[Record], update):
+        """
+        Group, optionally buffer, and write records into the database. Called by :any:`push` once the push is registered as in progress.
+
+        :type records: list[:any:`Record`]
+        :param records: List of records generated by inlets.
+
+        :type update: :any:`Update`
+        :param update: Update object representing the particular Link transfer.
+        """
+
+        # Checked inline rather than through ensure_connection, as push is called on every transfer.
+        if self._db is None:
+            self.connect()
+
         records_by_collections = self._group_by_collection(records)
 
+        buffering = self.buffer_size is not None or self.buffer_interval is not None
+        if buffering:
+            records_by_collections = self._buffer_records(records_by_collections)
+            if records_by_collections is None:
+                return True
+
+        batches = []
         for collection_name, collection_records in records_by_collections.items():
+            if self.ordered:
+                # ordered batches have to be written one after another
+                batches.append((collection_name, collection_records))
+            else:
+                for i in range(0, len(collection_records), self.batch_size):
+                    batches.append((collection_name, collection_records[i:i + self.batch_size]))
+
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[loop.run_in_executor(self._executor, self._write_collection, collection_name, batch, update)
+                                         for collection_name, batch in batches], return_exceptions=True)
+
+        failed = [(batch, result) for batch, result in zip(batches, results) if isinstance(result, BaseException)]
+        if failed:
+            if buffering:
+                # documents from earlier pushes have already been reported as written, keep them for the next write
+                # if the failure is transient. Anything else would fail again, blocking the buffer.
+                self._rebuffer([batch for batch, error in failed if isinstance(error, ConnectionFailure)])
+                for (collection_name, documents), error in failed:
+                    if not isinstance(error, ConnectionFailure):
+                        _LOGGER.error('%s dropped %d buffered documents for %s: %s', update, len(documents), collection_name, error)
+            raise failed[0][1]
 
-            try:
-                collection = self._get_collection(collection_name)
-            except MongoCollectionNotFound:
-                self._add_collection(collection_name)
-                collection = self._get_collection(collection_name)
+        return True
 
-            _LOGGER.info(f'{update} insert {collection_records}')
-            collection.insert_many(collection_records)
-            _LOGGER.info(f'{update} written {collection_records}')
+    def _buffer_records(self, records_by_collections:Dict[str, list]):
+        """
+        Add grouped documents to the buffer. If the buffer is due to be written, it is emptied and its contents returned.
 
-        return True
+        :type records_by_collections: Dict[str, list]
+        :param records_by_collections: Documents grouped by collection name.
+
+        :return: Buffered documents grouped by collection name if they should be written now, None otherwise.
+        :rtype: Dict[str, list]
+        """
+        with self._buffer_lock:
+            for collection_name, collection_records in records_by_collections.items():
+                self._buffer[collection_name].extend(collection_records)
+                self._buffer_count += len(collection_records)
+
+            now = time.monotonic()
+            if (self.buffer_size is None or self._buffer_count < self.buffer_size) \
+                    and (self.buffer_interval is None or now - self._last_flush < self.buffer_interval):
+                return None
+
+            return self._take_buffer(now)
+
+    def _rebuffer(self, batches:List[Tuple[str, list]]):
+        """
+        Put documents that failed to be written back at the front of the buffer. As :any:`on_shutdown` waits for pushes in progress, these documents are written on shutdown at the latest.
+
+        :type batches: list[tuple[str, list]]
+        :param batches: Pairs of collection name and documents that failed to be written.
+        """
+        with self._buffer_lock:
+            for collection_name, documents in batches:
+                self._buffer[collection_name][:0] = documents
+                self._buffer_count += len(documents)
+
+    def _take_buffer(self, now:float) -> Dict[str, list]:
+        """
+        Empty the buffer and return its contents. Must be called while holding the buffer lock.
+
+        :type now: float
+        :param now: Time of the flush, as returned by :any:`time.monotonic`.
+
+        :return: Buffered documents grouped by collection name.
+        :rtype: Dict[str, list]
+        """
+        buffered = dict(self._buffer)
+        self._buffer = defaultdict(list)
+        self._buffer_count = 0
+        self._last_flush = now
+        return buffered
+
+    def _write_collection(self, collection_name:str, documents:list, update):
+        """
+        Write documents into a collection. MongoDB creates the collection on the first insert if it doesn't exist yet. This call blocks until the writes are complete.
+
+        :type collection_name: str
+        :param collection_name: Name of the collection to write to.
+
+        :type documents: list
+        :param documents: Documents to be written.
+
+        :type update: :any:`Update`
+        :param update: Update object representing the particular Link transfer.
+        """
+        if self._db is None:
+            raise RuntimeError('%s is disconnected, cannot write to collection "%s"' % (self, collection_name))
+
+        collection = self._get_collection(collection_name)
+
+        # Log document counts lazily, formatting whole batches can cost more than writing them.
+        _LOGGER.info('%s insert %d documents to %s', update, len(documents), collection_name)
+        for i in range(0, len(documents), self.batch_size):
+            collection.insert_many(documents[i:i + self.batch_size], ordered=self.ordered)
+        _LOGGER.info('%s written %d documents to %s', update, len(documents), collection_name)
 
     def connect(self, database_name:str=None) -> bool:
         """
@@ -149,15 +335,17 @@ class MongoOutlet(Outlet):
 
 
         # if isinstance(self._client, pymongo.MongoClient) and isinstance(self._db, pymongo.database.Database):
-        if self._client is not None and self._db is not None:
-            if self._db.name == database_name:
+        if self._client is not None:
+            if self._db is not None and self._db.name == database_name:
                 return True
             else:
                 self.disconnect()
 
-        # self._client = MongoClient(host='172.18.0.2', port=27017)
-        self._client = pymongo.MongoClient(host=self.host, port=self.port)
-        self._db = self._client[database_name]
+        self._client = self._acquire_client()
+        if self.fast_insert:
+            self._db = self._client.get_database(database_name, write_concern=WriteConcern(w=0))
+        else:
+            self._db = self._client[database_name]
         return False
 
     def disconnect(self):
@@ -165,51 +353,156 @@ class MongoOutlet(Outlet):
         Disconnect from the database if currently connected.
         """
         if self._client is not None:
-            self._client.close()
+            self._release_client()
             self._client = None
 
         if self._db is not None:
             self._db = None
 
+        self._collections = None
+        self._collection_cache = {}
+
+    def _acquire_client(self) -> pymongo.MongoClient:
+        """
+        Get a MongoClient for this outlet's host, port and client options. Outlets connecting to the same host with the same options share one client - and with it its connection pool - instead of each opening their own.
+
+        :return: Shared MongoClient
+        :rtype: :any:`pymongo.MongoClient`
+        """
+        key = (self.host, self.port, self.max_pool_size, self.compressors, self.retry_writes)
+        with self._clients_lock:
+            if key not in self._clients:
+                self._clients[key] = [pymongo.MongoClient(host=self.host, port=self.port, **self._client_options()), 0]
+            self._clients[key][1] += 1
+            self._client_key = key
+            return self._clients[key][0]
+
+    def _client_options(self) -> dict:
+        """
+        Build the keyword arguments passed to MongoClient. Options left as :code:`None` are omitted, letting PyMongo apply its defaults.
+
+        :return: MongoClient keyword arguments
+        :rtype: dict
+        """
+        options = {'maxPoolSize': self.max_pool_size, 'retryWrites': self.retry_writes}
+        if self.compressors is not None:
+            options['compressors'] = self.compressors
+        return options
+
+    def _release_client(self):
+        """
+        Release the client acquired with :any:`_acquire_client`. The client is closed once no outlets use it.
+        """
+        with self._clients_lock:
+            entry = self._clients.get(self._client_key)
+            if entry is None or entry[0] is not self._client:
+                self._client.close()
+                return
+
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._clients[self._client_key]
+                self._client.close()
+
     def on_start(self):
         """
-        Connect to the MongoDB host on start.
+        Connect to the MongoDB host and start the write thread pool on start.
         """
         self.connect()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='MongoOutlet')
+        with self._buffer_lock:
+            self._last_flush = time.monotonic()
+        with self._pushes_condition:
+            self._closed = False
 
     def on_shutdown(self):
         """
-        Disconnect from the MongoDB host on shutdown.
+        Wait for pushes in progress to complete, write any buffered documents, stop the write thread pool and disconnect from the MongoDB host on shutdown. Buffered documents that fail to be written are lost and logged as errors.
         """
+        with self._pushes_condition:
+            self._closed = True
+            self._pushes_condition.wait_for(lambda: self._pushes_in_flight == 0)
+
+        with self._buffer_lock:
+            buffered = self._take_buffer(time.monotonic())
+
+        for collection_name, collection_records in buffered.items():
+            try:
+                self._write_collection(collection_name, collection_records, 'shutdown')
+            except Exception as e:
+                _LOGGER.exception('%s lost %d buffered documents for %s: %s', self, len(collection_records), collection_name, e)
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
         self.disconnect()
 
     def _get_collection(self, collection:str):
         """
-        Get a collection from the database.
+        Get a collection from the database. Collection handles are cached, skipping their construction on subsequent calls.
+
+        Existence of the collection is not verified, as MongoDB creates collections on the first insert. Use :any:`_add_collection` to create a collection explicitly.
 
         :type collection: str
         :param collection: Collection to acquire from the database.
 
-        :rises: :any:`MongoCollectionNotFound` if collection is not found in the database.
-
         :return: Retrieved collection
         :rtype: PyMongo Collection
         """
-        if str(collection) not in self._collections:
-            self._collections = self._db.list_collection_names()
-            if str(collection) not in self._collections:
-                raise MongoCollectionNotFound('Collection called "%s" not found. Please create the collection first using add_collection(). Existing collection are: %s' % (collection, self._collections))
-
-        return self._db[str(collection)]
+        cached = self._collection_cache.get(collection)
+        if cached is None:
+            cached = self._collection_cache[collection] = self._db[str(collection)]
+        return cached
 
     @ensure_connection
     def _add_collection(self, collection:str):
         """
         |decorated| :any:`ensure_connection`
 
-        Add a collection to the database.
+        Add a collection to the database. Adding a collection that already exists has no effect, hence concurrent calls for the same collection are safe.
 
         :type collection: str
         :param collection: Collection name to add
         """
-        self._db.create_collection(str(collection))
+        name = str(collection)
+        with self._collections_lock:
+            if self._collections is None:
+                self._collections = set(self._db.list_collection_names())
+
+            if name in self._collections:
+                return
+
+            try:
+                self._db.create_collection(name)
+            except CollectionInvalid: # created outside of this outlet
+                pass
+
+            self._collections.add(name)
+
+
+class SingleCollectionMongoOutlet(MongoOutlet):
+    """
+    :any:`MongoOutlet` writing all records into its global collection. Records' :any:`MONGODB_COLLECTION <MongoOutlet.MONGODB_COLLECTION>` metadata is ignored, which saves grouping the records by collection on each push.
+    """
+
+    def _group_by_collection(self, records:List[Record]):
+        """
+        Gather payloads of all provided records under the global collection provided on construction.
+
+        :type records: list[:any:`Record`]
+        :param records: Records to be grouped
+        :return: Grouped records
+        :rtype: Dict[str, :any:`Record`]
+        """
+        documents = []
+
+        for record in records:
+            payload = record.payload
+
+            if isinstance(payload, list):
+                documents.extend(payload)
+            else:
+                documents.append(payload)
+
+        return {self.collection: documents} if documents else {}
@@ -132,6 +132,7 @@ SKIP_FULL = {'databay.link.Link._run',
              'databay.outlet.metadata',
              # 'databay.inlet.Inlet.__repr__',
              'databay.outlets.MongoOutlet',
+             'databay.outlets.SingleCollectionMongoOutlet',
              # 'databay.outlet.Outlet.__init__',
              # 'databay.outlet.Outlet.__repr__',
              # 'databay.planners.aps_planner.APSPlanner.__repr__',
@@ -1,12 +1,19 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest import TestCase
 
 import mongomock
+import pymongo
 from asynctest import patch, MagicMock
 from mongomock import Collection
+from pymongo.errors import AutoReconnect, BulkWriteError
+from pymongo.write_concern import WriteConcern
 
 from databay import Record, Update
-from databay.outlets import MongoOutlet
-from databay.outlets.mongo_outlet import MongoCollectionNotFound, ensure_connection
+from databay.outlets import MongoOutlet, SingleCollectionMongoOutlet
+from databay.outlets.mongo_outlet import ensure_connection
 from test_utils import fqname
 
 class TestMongoOutlet(TestCase):
@@ -14,6 +21,9 @@ class TestMongoOutlet(TestCase):
     def setUp(self):
         self.outlet = MongoOutlet()
 
+    def tearDown(self):
+        MongoOutlet._clients.clear()
+
     @mongomock.patch(servers=(('localhost', 27017),))
     def test_connect(self):
 
@@ -40,6 +50,15 @@ class TestMongoOutlet(TestCase):
         self.assertFalse(result)
         self.assertEqual(self.outlet._db.name, 'my_database')
 
+    @patch('pymongo.MongoClient')
+    def test_connect_fast_insert(self, client):
+        self.outlet = MongoOutlet(fast_insert=True)
+
+        self.outlet.connect()
+
+        client.return_value.get_database.assert_called_once_with('databay', write_concern=WriteConcern(w=0))
+        self.assertEqual(self.outlet._db, client.return_value.get_database.return_value)
+
     @mongomock.patch(servers=(('localhost', 27017),))
     def test_connect_twice_same(self):
         result = self.outlet.connect()
@@ -66,21 +85,69 @@ class TestMongoOutlet(TestCase):
         close_mock = MagicMock()
         self.outlet._client = MagicMock(close=close_mock)
         self.outlet._db = MagicMock()
+        self.outlet._collection_cache = {'test_collection': MagicMock()}
         self.outlet.disconnect()
 
         close_mock.assert_called_once()
         self.assertIsNone(self.outlet._client)
         self.assertIsNone(self.outlet._db)
+        self.assertEqual(self.outlet._collection_cache, {})
+
+    @patch('pymongo.MongoClient')
+    def test_connect_client_options(self, client):
+        self.outlet = MongoOutlet(max_pool_size=500, compressors='zlib', retry_writes=False)
+
+        self.outlet.connect()
+
+        client.assert_called_once_with(host=None, port=None, maxPoolSize=500, compressors='zlib', retryWrites=False)
+
+    def test__client_options_default(self):
+        options = self.outlet._client_options()
+        self.assertNotIn('compressors', options)
+
+        client = pymongo.MongoClient(host=self.outlet.host, port=self.outlet.port, connect=False, **options)
+        client.close()
+
+    @patch('pymongo.MongoClient')
+    def test_connect_shared_client(self, client):
+        outletA = MongoOutlet('A')
+        outletB = MongoOutlet('B')
+
+        outletA.connect()
+        outletB.connect()
+
+        client.assert_called_once_with(host=None, port=None, maxPoolSize=100, retryWrites=True)
+        self.assertIs(outletA._client, outletB._client)
+
+        outletA.disconnect()
+        client.return_value.close.assert_not_called()
+
+        outletB.disconnect()
+        client.return_value.close.assert_called_once()
+        self.assertEqual(MongoOutlet._clients, {})
 
     def test_on_start(self):
         self.outlet.connect = MagicMock()
         self.outlet.on_start()
         self.outlet.connect.assert_called_once()
+        self.assertIsInstance(self.outlet._executor, ThreadPoolExecutor)
+        self.outlet._executor.shutdown()
+
+    def test_on_start_resets_last_flush(self):
+        self.outlet.connect = MagicMock()
+        self.outlet._last_flush -= 60
+
+        self.outlet.on_start()
+        self.assertLess(time.monotonic() - self.outlet._last_flush, 1)
+        self.outlet._executor.shutdown()
 
     def test_on_shutdown(self):
         self.outlet.disconnect = MagicMock()
+        executor = self.outlet._executor = MagicMock()
         self.outlet.on_shutdown()
         self.outlet.disconnect.assert_called_once()
+        executor.shutdown.assert_called_once_with(wait=True)
+        self.assertIsNone(self.outlet._executor)
 
     @mongomock.patch(servers=(('localhost', 27017),))
     def test__add_collection(self):
@@ -107,13 +174,43 @@ class TestMongoOutlet(TestCase):
         self.assertIsInstance(collection, Collection)
 
     @mongomock.patch(servers=(('localhost', 27017),))
-    def test__get_collection_invalid(self):
+    def test__get_collection_cached(self):
         name = 'test_collection'
         self.outlet._add_collection(name)
-        self.assertTrue(name in self.outlet._db.list_collection_names(), f'Database should contain collection \'{name}\'')
-        self.assertIsInstance(self.outlet._db[name], Collection)
 
-        self.assertRaises(MongoCollectionNotFound, self.outlet._get_collection, 'invalid_name')
+        collection = self.outlet._get_collection(name)
+        self.outlet._db = MagicMock()
+        self.assertIs(self.outlet._get_collection(name), collection)
+        self.outlet._db.list_collection_names.assert_not_called()
+
+    def test__add_collection_registered(self):
+        self.outlet._db = MagicMock()
+        self.outlet._db.list_collection_names.return_value = ['A']
+
+        self.outlet._add_collection('A')
+        self.outlet._add_collection('B')
+        self.outlet._add_collection('B')
+
+        self.outlet._db.list_collection_names.assert_called_once()
+        self.outlet._db.create_collection.assert_called_once_with('B')
+        self.assertEqual(self.outlet._collections, {'A', 'B'})
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    def test__add_collection_existing(self):
+        name = 'test_collection'
+        self.outlet.connect()
+        self.outlet._db.create_collection(name)
+
+        self.outlet._add_collection(name)
+        self.assertIsInstance(self.outlet._get_collection(name), Collection)
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    def test__get_collection_missing(self):
+        self.outlet.connect()
+
+        collection = self.outlet._get_collection('new_collection')
+        self.assertIsInstance(collection, Collection)
+        self.assertNotIn('new_collection', self.outlet._db.list_collection_names())
 
     @mongomock.patch(servers=(('localhost', 27017),))
     @patch(fqname(Record), spec=Record)
@@ -170,7 +267,7 @@ class TestMongoOutlet(TestCase):
 
         records = [recordA, recordB]
         self.outlet.try_start()
-        self.outlet.push(records, update)
+        asyncio.run(self.outlet.push(records, update))
 
 
         for record in records:
@@ -185,13 +282,40 @@ class TestMongoOutlet(TestCase):
 
         self.outlet.try_shutdown()
 
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    def test_push_non_str_collection(self, record, update):
+        record.metadata = {MongoOutlet.MONGODB_COLLECTION: 2020}
+        record.payload = {'test': 1}
+
+        self.outlet.try_start()
+        asyncio.run(self.outlet.push([record], update))
+
+        self.assertEqual(self.outlet._db['2020'].find_one({'_id': record.payload['_id']}), record.payload)
+        self.outlet.try_shutdown()
+
     @mongomock.patch(servers=(('localhost', 27017),))
     @patch(fqname(Update), spec=Update)
     @patch(fqname(Record), spec=Record)
     def test_push_inactive(self, record, update):
-        result = self.outlet.push([record], update)
+        result = asyncio.run(self.outlet.push([record], update))
         self.assertFalse(result, 'Push should have stopped and returned False')
 
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    def test_push_connects(self, record, update):
+        record.metadata = {}
+        record.payload = {'test': 1}
+
+        self.outlet._active = True
+        self.assertIsNone(self.outlet._db)
+        asyncio.run(self.outlet.push([record], update))
+
+        self.assertIsNotNone(self.outlet._db)
+        self.assertEqual(self.outlet._get_collection(self.outlet.collection).find_one({'_id': record.payload['_id']}), record.payload)
+
     @mongomock.patch(servers=(('localhost', 27017),))
     def test_ensure_connection(self):
         mock = MagicMock(foo=MagicMock(), _db=None)
@@ -201,3 +325,297 @@ class TestMongoOutlet(TestCase):
         mock.connect.assert_called_once()
         mock.foo.assert_called_once()
 
+    def test_push_uses_coroutine(self):
+        self.assertTrue(self.outlet._uses_coroutine)
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    def test_push_batches(self, record, update):
+        record.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        record.payload = [{'test': i} for i in range(5)]
+
+        self.outlet = MongoOutlet(batch_size=2, ordered=True)
+        self.outlet.try_start()
+        collection = MagicMock()
+        self.outlet._get_collection = MagicMock(return_value=collection)
+        asyncio.run(self.outlet.push([record], update))
+
+        self.assertEqual(collection.insert_many.call_count, 3)
+        self.assertEqual(collection.insert_many.call_args_list[0][0][0], record.payload[0:2])
+        self.assertEqual(collection.insert_many.call_args_list[1][0][0], record.payload[2:4])
+        self.assertEqual(collection.insert_many.call_args_list[2][0][0], record.payload[4:5])
+        for call in collection.insert_many.call_args_list:
+            self.assertEqual(call[1], {'ordered': True})
+
+        self.outlet.try_shutdown()
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    @patch(fqname(Record), spec=Record)
+    def test_push_collections_concurrently(self, recordA, recordB, update):
+        recordA.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        recordB.metadata = {MongoOutlet.MONGODB_COLLECTION: 'B'}
+        recordA.payload = {'testA': 1}
+        recordB.payload = {'testB': 2}
+
+        barrier = threading.Barrier(2, timeout=1)
+        self.outlet.try_start()
+        self.outlet._write_collection = MagicMock(side_effect=lambda *args: barrier.wait())
+        asyncio.run(self.outlet.push([recordA, recordB], update))
+
+        self.assertEqual(self.outlet._write_collection.call_count, 2)
+        self.outlet.try_shutdown()
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    def test_push_batches_unordered(self, record, update):
+        record.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        record.payload = [{'test': i} for i in range(5)]
+
+        barrier = threading.Barrier(3, timeout=1)
+        self.outlet = MongoOutlet(batch_size=2)
+        self.outlet.try_start()
+        self.outlet._write_collection = MagicMock(side_effect=lambda *args: barrier.wait())
+        asyncio.run(self.outlet.push([record], update))
+
+        batches = sorted([call[0][1] for call in self.outlet._write_collection.call_args_list], key=lambda b: b[0]['test'])
+        self.assertEqual(batches, [record.payload[0:2], record.payload[2:4], record.payload[4:5]])
+
+        self.outlet.try_shutdown()
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    @patch(fqname(Record), spec=Record)
+    def test_push_buffer_size(self, recordA, recordB, update):
+        recordA.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        recordB.metadata = {MongoOutlet.MONGODB_COLLECTION: 'B'}
+        recordA.payload = [{'testA': 1}, {'testA': 2}]
+        recordB.payload = {'testB': 3}
+
+        self.outlet = MongoOutlet(buffer_size=3)
+        self.outlet.try_start()
+        self.outlet._write_collection = MagicMock()
+
+        asyncio.run(self.outlet.push([recordA], update))
+        self.outlet._write_collection.assert_not_called()
+
+        asyncio.run(self.outlet.push([recordB], update))
+        self.outlet._write_collection.assert_any_call('A', recordA.payload, update)
+        self.outlet._write_collection.assert_any_call('B', [recordB.payload], update)
+        self.assertEqual(self.outlet._buffer_count, 0)
+
+        self.outlet.try_shutdown()
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    def test_push_buffer_interval(self, record, update):
+        record.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        record.payload = {'test': 1}
+
+        self.outlet = MongoOutlet(buffer_interval=60)
+        self.outlet.try_start()
+        self.outlet._write_collection = MagicMock()
+
+        asyncio.run(self.outlet.push([record], update))
+        self.outlet._write_collection.assert_not_called()
+
+        self.outlet._last_flush -= 60
+        asyncio.run(self.outlet.push([record], update))
+        self.outlet._write_collection.assert_called_once_with('A', [record.payload, record.payload], update)
+
+        self.outlet.try_shutdown()
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    def test_on_shutdown_flushes_buffer(self, record, update):
+        record.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        record.payload = {'test': 1}
+
+        self.outlet = MongoOutlet(buffer_size=10)
+        self.outlet.try_start()
+        asyncio.run(self.outlet.push([record], update))
+        collection = self.outlet._db['A']
+        self.assertIsNone(collection.find_one({'test': 1}))
+
+        self.outlet.try_shutdown()
+        self.assertEqual(collection.find_one({'test': 1}), record.payload)
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    def test_on_shutdown_waits_for_push(self, record, update):
+        record.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        record.payload = {'test': 1}
+
+        self.outlet.try_start()
+        collection = self.outlet._db['A']
+
+        started = threading.Event()
+        release = threading.Event()
+        write_collection = self.outlet._write_collection
+        def slow_write(*args):
+            started.set()
+            release.wait(1)
+            write_collection(*args)
+        self.outlet._write_collection = slow_write
+
+        pusher = threading.Thread(target=asyncio.run, args=(self.outlet.push([record], update),))
+        pusher.start()
+        self.assertTrue(started.wait(1))
+
+        shutdown = threading.Thread(target=self.outlet.try_shutdown)
+        shutdown.start()
+        shutdown.join(0.1)
+        self.assertTrue(shutdown.is_alive(), 'Shutdown should wait for the push in progress')
+        self.assertIsNotNone(self.outlet._db)
+
+        release.set()
+        pusher.join(1)
+        shutdown.join(1)
+
+        self.assertEqual(collection.find_one({'_id': record.payload['_id']}), record.payload)
+        self.assertIsNone(self.outlet._db)
+
+    def test__write_collection_disconnected(self):
+        self.assertRaises(RuntimeError, self.outlet._write_collection, 'A', [{'test': 1}], 'update')
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    def test_push_buffer_during_shutdown(self, record, update):
+        record.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        record.payload = {'test': 1}
+
+        self.outlet = MongoOutlet(buffer_size=10)
+        self.outlet.try_start()
+
+        # push that passed the active check before on_shutdown ran
+        self.outlet.on_shutdown()
+        result = asyncio.run(self.outlet.push([record], update))
+
+        self.assertFalse(result, 'Push should have stopped and returned False')
+        self.assertIsNone(self.outlet._db)
+        self.assertEqual(MongoOutlet._clients, {})
+        self.assertEqual(self.outlet._buffer_count, 0)
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    @patch(fqname(Record), spec=Record)
+    def test_push_buffer_write_failed(self, recordA, recordB, update):
+        recordA.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        recordB.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        recordA.payload = {'testA': 1}
+        recordB.payload = {'testB': 2}
+
+        self.outlet = MongoOutlet(buffer_size=1, ordered=True)
+        self.outlet.try_start()
+        self.outlet._write_collection = MagicMock(side_effect=AutoReconnect('connection lost'))
+
+        self.assertRaises(AutoReconnect, asyncio.run, self.outlet.push([recordA], update))
+        self.assertEqual(self.outlet._buffer['A'], [recordA.payload])
+        self.assertEqual(self.outlet._buffer_count, 1)
+
+        self.outlet._write_collection = MagicMock()
+        asyncio.run(self.outlet.push([recordB], update))
+        self.outlet._write_collection.assert_called_once_with('A', [recordA.payload, recordB.payload], update)
+
+        self.outlet.try_shutdown()
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    def test_push_buffer_write_rejected(self, record, update):
+        record.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        record.payload = {'test': 1}
+
+        self.outlet = MongoOutlet(buffer_size=1)
+        self.outlet.try_start()
+        self.outlet._write_collection = MagicMock(side_effect=BulkWriteError({}))
+
+        with self.assertLogs('databay.MongoOutlet', level='ERROR'):
+            self.assertRaises(BulkWriteError, asyncio.run, self.outlet.push([record], update))
+        self.assertEqual(self.outlet._buffer_count, 0)
+
+        self.outlet.try_shutdown()
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    @patch(fqname(Record), spec=Record)
+    def test_push_buffer_invalid_document(self, recordA, recordB, update):
+        recordA.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        recordB.metadata = {MongoOutlet.MONGODB_COLLECTION: 'B'}
+        recordA.payload = 'not a document'
+        recordB.payload = {'ok': 1}
+
+        self.outlet = MongoOutlet(buffer_size=1)
+        self.outlet.try_start()
+
+        with self.assertLogs('databay.MongoOutlet', level='ERROR'):
+            self.assertRaises(TypeError, asyncio.run, self.outlet.push([recordA], update))
+        self.assertEqual(self.outlet._buffer_count, 0)
+
+        asyncio.run(self.outlet.push([recordB], update))
+        self.assertEqual(self.outlet._db['B'].find_one({'_id': recordB.payload['_id']}), recordB.payload)
+
+        self.outlet.try_shutdown()
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    def test_on_shutdown_buffer_write_failed(self, record, update):
+        record.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        record.payload = {'test': 1}
+
+        self.outlet = MongoOutlet(buffer_size=10)
+        self.outlet.try_start()
+        asyncio.run(self.outlet.push([record], update))
+        self.outlet._write_collection = MagicMock(side_effect=AutoReconnect('connection lost'))
+
+        with self.assertLogs('databay.MongoOutlet', level='ERROR'):
+            self.outlet.try_shutdown()
+        self.assertIsNone(self.outlet._db)
+
+
+class TestSingleCollectionMongoOutlet(TestCase):
+
+    def setUp(self):
+        self.outlet = SingleCollectionMongoOutlet(collection='C')
+
+    def tearDown(self):
+        MongoOutlet._clients.clear()
+
+    @patch(fqname(Record), spec=Record)
+    @patch(fqname(Record), spec=Record)
+    def test__group_by_collection(self, recordA, recordB):
+        recordA.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        recordB.metadata = {}
+        recordA.payload = 'testA'
+        recordB.payload = ['testB', 'testB2']
+
+        collections = self.outlet._group_by_collection([recordA, recordB])
+        self.assertEqual(collections, {'C': ['testA', 'testB', 'testB2']})
+
+    def test__group_by_collection_empty(self):
+        self.assertEqual(self.outlet._group_by_collection([]), {})
+
+    @mongomock.patch(servers=(('localhost', 27017),))
+    @patch(fqname(Update), spec=Update)
+    @patch(fqname(Record), spec=Record)
+    def test_push(self, record, update):
+        record.metadata = {MongoOutlet.MONGODB_COLLECTION: 'A'}
+        record.payload = {'test': 1}
+
+        self.outlet.try_start()
+        asyncio.run(self.outlet.push([record], update))
+
+        self.assertEqual(self.outlet._db['C'].find_one({'_id': record.payload['_id']}), record.payload)
+        self.assertNotIn('A', self.outlet._db.list_collection_names())
+        self.outlet.try_shutdown()